@@ -1,22 +1,41 @@
 # --- 1. IMPORTACIONES CORREGIDAS (Todas al inicio) ---
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, send_file, session
+from flask import Flask, Request, render_template, request, redirect, url_for, send_from_directory, send_file, session, abort, jsonify, g
+import hashlib
+import io
+import json
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from cachetools import LRUCache, TTLCache
 from fpdf import FPDF 
-from PIL import Image # <-- Importación de Pillow (PIL)
+from PIL import Image, ImageCms, ImageFile, ImageOps # <-- Importación de Pillow (PIL)
 # Importaciones para IA
 from google import genai
+from google.genai import types
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+import httpx
 from dotenv import load_dotenv
+from pydantic import BaseModel
 
 # Cargar variables de entorno desde .env si existe (para desarrollo local)
 load_dotenv()
 
 # Inicializar la variable del cliente de Gemini a None para que siempre exista.
 gemini_client = None
+# Tiempo máximo de cada llamada HTTP a Gemini (segundos)
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_TIMEOUT_SECONDS', 20))
 
 try:
     # Intentar inicializar el cliente (busca la clave en Render o en .env)
-    gemini_client = genai.Client()
+    gemini_client = genai.Client(http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT_SECONDS * 1000)))
 except Exception as e:
     # Si falla, gemini_client sigue siendo None.
     # Es vital que el servidor NO se caiga, y este try/except lo evita.
@@ -35,82 +54,1389 @@ if not os.path.exists(UPLOAD_FOLDER):
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 # Define las extensiones de archivo permitidas (seguridad)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# Formatos reales (según el contenido, no la extensión) que se aceptan
+ALLOWED_IMAGE_FORMATS = {'PNG', 'JPEG'}
+# Límites de subida: por archivo y por petición completa (Flask responde 413 al superarlo)
+MAX_UPLOAD_FILE_BYTES = int(os.environ.get('MAX_UPLOAD_FILE_BYTES', 25 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_REQUEST_BYTES', 200 * 1024 * 1024))
+# Bytes que se analizan como máximo buscando la cabecera de la imagen
+UPLOAD_SNIFF_BYTES = 1024 * 1024
+
+# Límites para la generación de PDFs (cada petición construye su propio PDF en memoria)
+# fpdf2 no puede escribir el PDF por partes: cada uno ocupa en memoria entero (y
+# brevemente el doble al volcarlo), así que lo que acota la memoria es este límite.
+# Máximo de PDFs construyéndose a la vez en este proceso (evita agotar la memoria)
+MAX_CONCURRENT_PDF_BUILDS = int(os.environ.get('MAX_CONCURRENT_PDF_BUILDS', 2))
+# Segundos que una petición espera un turno antes de responder "ocupado"
+PDF_BUILD_WAIT_SECONDS = float(os.environ.get('PDF_BUILD_WAIT_SECONDS', 30))
+pdf_build_slots = threading.BoundedSemaphore(MAX_CONCURRENT_PDF_BUILDS)
+
+# Página A4 en milímetros
+PDF_WIDTH = 210
+PDF_HEIGHT = 297
+# Preprocesado de imágenes antes de meterlas en el PDF
+PDF_IMAGE_DPI = int(os.environ.get('PDF_IMAGE_DPI', 150))  # Resolución objetivo dentro de la página
+PDF_JPEG_QUALITY = int(os.environ.get('PDF_JPEG_QUALITY', 85))
+PDF_PNG_COMPRESS_LEVEL = int(os.environ.get('PDF_PNG_COMPRESS_LEVEL', 6))
+IMAGE_PREPROCESS_WORKERS = int(os.environ.get('IMAGE_PREPROCESS_WORKERS', os.cpu_count() or 2))
+# Pool compartido: Pillow libera el GIL al decodificar, redimensionar y codificar
+image_preprocess_pool = ThreadPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS, thread_name_prefix='img-prep')
+
+# --- MÉTRICAS (tiempos por etapa y contadores, formato de texto de Prometheus) ---
+
+class Metrics:
+    """Contadores e histogramas en memoria para el endpoint /metrics.
+
+    Cada operación es un diccionario protegido por un lock, así que el coste
+    es despreciable frente a decodificar una imagen o generar un PDF. Los
+    valores son de este proceso: con varios workers de gunicorn, cada uno
+    tiene los suyos.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, definitions):
+        self.definitions = definitions  # nombre -> (tipo, descripción)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        """Todas las métricas en el formato de texto de Prometheus"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: {**value, 'buckets': list(value['buckets'])} for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (kind, description) in self.definitions.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (series, labels), value in sorted(counters.items()):
+                    if series == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            else:
+                for (series, labels), histogram in sorted(histograms.items()):
+                    if series != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    """(('stage', 'pdf_output'),) -> {stage="pdf_output"}"""
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+metrics = Metrics({
+    'portfolio_http_request_duration_seconds': ('histogram', "Duración de las peticiones HTTP por endpoint"),
+    'portfolio_stage_duration_seconds': ('histogram', "Duración de cada etapa (subida, decodificación, PDF, Gemini...)"),
+    'portfolio_uploaded_bytes_total': ('counter', "Bytes de imágenes aceptadas en /upload"),
+    'portfolio_uploaded_files_total': ('counter', "Archivos subidos, por resultado (accepted/rejected)"),
+    'portfolio_pdf_pages_rendered_total': ('counter', "Páginas añadidas a los PDFs generados"),
+    'portfolio_pdfs_built_total': ('counter', "PDFs generados"),
+    'portfolio_files_reaped_total': ('counter', "Archivos subidos borrados por caducidad o cuota"),
+    'portfolio_derivative_cache_requests_total': ('counter', "Consultas a la caché de derivados, por resultado (hit/miss)"),
+    'portfolio_gemini_requests_total': ('counter', "Peticiones de IA, por resultado (cache_hit/coalesced/ok/error)"),
+})
+
+# Si está activado, cada etapa escribe también una línea JSON en el log
+METRICS_LOG = os.environ.get('METRICS_LOG', '').lower() in ('1', 'true', 'yes')
+
+@contextmanager
+def timed_stage(stage):
+    """Mide la duración de un bloque y la registra en portfolio_stage_duration_seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('portfolio_stage_duration_seconds', elapsed, stage=stage)
+        if METRICS_LOG:
+            print(json.dumps({'event': 'stage', 'stage': stage, 'seconds': round(elapsed, 6)}))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or 'not_found'
+        metrics.observe(
+            'portfolio_http_request_duration_seconds', elapsed,
+            endpoint=endpoint, method=request.method, status=response.status_code
+        )
+        if METRICS_LOG:
+            print(json.dumps({
+                'event': 'request', 'endpoint': endpoint, 'method': request.method,
+                'status': response.status_code, 'seconds': round(elapsed, 6)
+            }))
+    return response
+
+# --- CACHÉ DE DERIVADOS (miniaturas y versiones para el PDF) ---
+
+class DerivativeCache:
+    """Caché en disco de versiones derivadas de las imágenes subidas.
+
+    Las entradas se identifican por el hash SHA-256 del contenido original, así
+    que una imagen subida dos veces (o usada en varios portafolios) comparte
+    sus derivados. El tamaño total está limitado: al superarlo se borran los
+    archivos usados hace más tiempo (la fecha de modificación se actualiza en
+    cada acierto, lo que funciona también entre varios workers de gunicorn).
+    """
+
+    EXTENSIONS = ('jpg', 'png')
+
+    def __init__(self, folder, max_bytes):
+        self.folder = os.path.abspath(folder)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # ruta -> (tamaño, mtime, hash): evita volver a leer archivos ya conocidos
+        self._digests = LRUCache(maxsize=4096)
+        self._approx_bytes = None
+        os.makedirs(folder, exist_ok=True)
+
+    def key_for(self, filepath):
+        """Hash del contenido de un archivo (memorizado mientras no cambie)"""
+        stat = os.stat(filepath)
+        with self._lock:
+            cached = self._digests.get(filepath)
+        if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        key = digest.hexdigest()
+
+        with self._lock:
+            self._digests[filepath] = (stat.st_size, stat.st_mtime_ns, key)
+        return key
+
+    def remember(self, filepath, key):
+        """Registra el hash ya calculado de un archivo (por ejemplo, al subirlo)"""
+        stat = os.stat(filepath)
+        with self._lock:
+            self._digests[filepath] = (stat.st_size, stat.st_mtime_ns, key)
+
+    def get(self, key, name):
+        """Ruta del derivado 'name' de la imagen 'key', o None si no existe"""
+        for ext in self.EXTENSIONS:
+            path = os.path.join(self.folder, f"{key}_{name}.{ext}")
+            try:
+                os.utime(path)  # Marca el uso para el orden LRU
+                metrics.inc('portfolio_derivative_cache_requests_total', result='hit')
+                return path
+            except FileNotFoundError:
+                continue
+        metrics.inc('portfolio_derivative_cache_requests_total', result='miss')
+        return None
+
+    def put(self, key, name, ext, data):
+        """Guarda un derivado y devuelve su ruta"""
+        path = os.path.join(self.folder, f"{key}_{name}.{ext}")
+        # Escribir en un archivo temporal y renombrar: nadie ve un archivo a medias
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._approx_bytes is not None:
+                self._approx_bytes += len(data)
+            over_limit = self._approx_bytes is None or self._approx_bytes > self.max_bytes
+        if over_limit:
+            self.trim()
+        return path
+
+    def trim(self):
+        """Borra los derivados menos usados hasta quedar bajo el límite de tamaño"""
+        entries = []
+        for entry in os.scandir(self.folder):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        removed_count = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed_count += 1
+            except FileNotFoundError:
+                total -= size
+            except Exception as e:
+                print(f"Error al eliminar derivado {path}: {e}")
+
+        with self._lock:
+            self._approx_bytes = total
+        return removed_count
+
+# Carpeta de la caché y tamaño máximo (por defecto 512 MB)
+CACHE_FOLDER = os.environ.get('CACHE_FOLDER', 'cache')
+DERIVATIVE_CACHE_MAX_BYTES = int(os.environ.get('DERIVATIVE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Miniaturas para la página de edición (el doble del tamaño mostrado, para pantallas retina)
+THUMBNAIL_SIZE = (560, 400)
+THUMBNAIL_QUALITY = 80
+derivative_cache = DerivativeCache(CACHE_FOLDER, DERIVATIVE_CACHE_MAX_BYTES)
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Etiqueta EXIF Orientation: con los valores 5 a 8 la imagen se muestra girada 90°
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+def is_rotated(img):
+    """True si la orientación EXIF intercambia el ancho y el alto de la imagen.
+
+    Lee la etiqueta de los bytes EXIF de la cabecera sin decodificar la imagen
+    (en PNG, getexif() la cargaría entera, y al subir aún no ha llegado).
+    """
+    raw_exif = img.info.get('exif')
+    if not raw_exif:
+        return False
+    exif = Image.Exif()
+    try:
+        exif.load(raw_exif)
+    except Exception:
+        return False  # EXIF dañado: se trata como sin orientación
+    return exif.get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS
+
+def oriented_size(img):
+    """(ancho, alto) de la imagen tal como se ve, aplicando la orientación EXIF"""
+    width, height = img.size
+    return (height, width) if is_rotated(img) else (width, height)
+
+# --- SUBIDAS EN STREAMING ---
+
+class UploadSpool:
+    """Destino de un archivo subido mientras Werkzeug lee la petición.
+
+    Escribe cada bloque directamente en un archivo temporal de la carpeta de
+    subidas y, a la vez, calcula el hash del contenido y pasa los primeros bytes
+    al parser incremental de PIL para conocer formato y dimensiones sin
+    decodificar la imagen. Si el archivo supera MAX_UPLOAD_FILE_BYTES o no es
+    una imagen válida, se deja de escribir y se guarda el motivo en 'error'.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.error = None
+        self.image_format = None
+        self.dimensions = None
+        self._digest = hashlib.sha256()
+        self._parser = ImageFile.Parser()
+        self._committed = False
+        self._file = tempfile.NamedTemporaryFile(dir=folder, prefix='.upload-', suffix='.part', delete=False)
+        self.path = self._file.name
+
+    @property
+    def content_hash(self):
+        return self._digest.hexdigest()
+
+    def write(self, data):
+        if self.error:
+            return len(data)  # Archivo rechazado: se descarta el resto
+
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self._reject(f"supera el tamaño máximo de {self.max_bytes // (1024 * 1024)} MB")
+            return len(data)
+
+        if self.dimensions is None:
+            self._sniff(data)
+            if self.error:
+                return len(data)
+
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def _sniff(self, data):
+        """Pasa bytes al parser de PIL hasta que reconoce la cabecera de la imagen"""
+        try:
+            self._parser.feed(data)
+        except Exception:
+            self._reject("no es una imagen válida")
+            return
+
+        image = self._parser.image
+        if image is None:
+            if self.size > UPLOAD_SNIFF_BYTES:
+                self._reject("no es una imagen válida")
+            return
+
+        if image.format not in ALLOWED_IMAGE_FORMATS:
+            self._reject(f"formato {image.format} no permitido")
+        elif Image.MAX_IMAGE_PIXELS and image.width * image.height > Image.MAX_IMAGE_PIXELS:
+            self._reject(f"la imagen es demasiado grande ({image.width}x{image.height})")
+        else:
+            self.image_format = image.format
+            self.dimensions = oriented_size(image)
+        # Ya no hace falta seguir decodificando
+        self._parser = None
+
+    def _reject(self, reason):
+        self.error = reason
+        self._parser = None
+        self._discard()
+
+    def _discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def commit(self, filepath):
+        """Mueve el archivo temporal a su nombre definitivo"""
+        self._file.close()
+        os.replace(self.path, filepath)
+        self.path = filepath
+        self._committed = True
+
+    # Métodos de archivo que necesita Werkzeug (FileStorage)
+    def seek(self, offset, whence=0):
+        return 0 if self._file.closed else self._file.seek(offset, whence)
+
+    def tell(self):
+        return self.size if self._file.closed else self._file.tell()
+
+    def read(self, size=-1):
+        return b'' if self._file.closed else self._file.read(size)
+
+    def readline(self, size=-1):
+        return b'' if self._file.closed else self._file.readline(size)
+
+    def close(self):
+        # Al terminar la petición: lo que no se haya guardado se borra
+        if not self._committed and not self.error:
+            self._discard()
+
+class UploadRequest(Request):
+    """Petición de Flask que envía los archivos subidos a un UploadSpool.
+
+    Guarda todos los UploadSpool que crea: si la lectura de la petición se
+    corta a medias (cliente desconectado, MAX_CONTENT_LENGTH superado...) los
+    archivos no llegan a request.files, pero close() los borra igualmente.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_spools = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = UploadSpool(app.config['UPLOAD_FOLDER'], MAX_UPLOAD_FILE_BYTES)
+        self.upload_spools.append(spool)
+        return spool
+
+    def close(self):
+        # Flask la llama al terminar cada petición, también cuando hubo errores
+        try:
+            super().close()
+        finally:
+            for spool in self.upload_spools:
+                spool.close()
+
+app.request_class = UploadRequest
+
+# --- ÍNDICE DE SUBIDAS Y LIMPIEZA EN SEGUNDO PLANO ---
+
+@contextmanager
+def closing_connection(conn):
+    """Confirma la transacción y cierra la conexión al salir del bloque with"""
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def connect_db(db_path):
+    """Conexión a la base de datos SQLite para un bloque with.
+
+    Una conexión por operación: sqlite3 no comparte conexiones entre hilos.
+    """
+    return closing_connection(sqlite3.connect(db_path, timeout=10))
+
+class UploadIndex:
+    """Registro persistente (SQLite) de los archivos subidos.
+
+    Guarda sesión, ruta, tamaño y fecha de cada archivo, de modo que la limpieza
+    no tiene que recorrer la carpeta uploads ni pedir la fecha de cada archivo.
+    La base de datos se comparte entre todos los workers de gunicorn.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with connect_db(self.db_path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    path TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    format TEXT,
+                    width INTEGER,
+                    height INTEGER
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS uploads_created_at ON uploads (created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS uploads_session_id ON uploads (session_id)")
+            # Bases de datos creadas antes de guardar los metadatos de la imagen
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(uploads)")}
+            for name, column_type in (('format', 'TEXT'), ('width', 'INTEGER'), ('height', 'INTEGER')):
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE uploads ADD COLUMN {name} {column_type}")
+
+    def add(self, session_id, path, size, image_format=None, dimensions=None):
+        width, height = dimensions or (None, None)
+        with connect_db(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO uploads (path, session_id, size, created_at, format, width, height)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, session_id, size, time.time(), image_format, width, height)
+            )
+
+    def files(self, session_id):
+        """Imágenes de una sesión de subida, en el orden en que se subieron"""
+        with connect_db(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT path, format, width, height, size FROM uploads WHERE session_id = ?"
+                " ORDER BY created_at, rowid",
+                (session_id,)
+            ).fetchall()
+        files = []
+        for path, image_format, width, height, size in rows:
+            filename = os.path.basename(path)
+            files.append({
+                'filename': filename,
+                'name': filename.split('_', 1)[-1],  # Nombre original, sin el id de la sesión
+                'format': image_format,
+                'width': width,
+                'height': height,
+                'size': size,
+            })
+        return files
+
+    def session_of(self, path):
+        """Sesión de subida a la que pertenece un archivo, o None si no está en el índice"""
+        with connect_db(self.db_path) as conn:
+            row = conn.execute("SELECT session_id FROM uploads WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def dimensions(self, paths):
+        """{ruta: (ancho, alto)} de los archivos cuyas dimensiones se conocen"""
+        with connect_db(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT path, width, height FROM uploads WHERE width IS NOT NULL"
+                f" AND path IN ({', '.join('?' * len(paths))})",
+                list(paths)
+            )
+            return {path: (width, height) for path, width, height in rows}
+
+    def remove(self, paths):
+        with connect_db(self.db_path) as conn:
+            conn.executemany("DELETE FROM uploads WHERE path = ?", [(path,) for path in paths])
+
+    def all_paths(self):
+        with connect_db(self.db_path) as conn:
+            return [row[0] for row in conn.execute("SELECT path FROM uploads")]
+
+    def expired(self, older_than):
+        """Rutas de los archivos subidos antes de la fecha older_than"""
+        with connect_db(self.db_path) as conn:
+            rows = conn.execute("SELECT path FROM uploads WHERE created_at < ?", (older_than,))
+            return [row[0] for row in rows]
+
+    def over_quota(self, quota_bytes):
+        """Rutas más antiguas que hay que borrar para que el total no supere quota_bytes"""
+        with connect_db(self.db_path) as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0]
+            paths = []
+            if total <= quota_bytes:
+                return paths
+            for path, size in conn.execute("SELECT path, size FROM uploads ORDER BY created_at"):
+                if total <= quota_bytes:
+                    break
+                paths.append(path)
+                total -= size
+            return paths
+
+    def reconcile(self, folder):
+        """Registra los archivos que ya estaban en la carpeta (se ejecuta una vez al arrancar)"""
+        with connect_db(self.db_path) as conn:
+            for entry in os.scandir(folder):
+                if entry.is_file() and entry.name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    stat = entry.stat()
+                    session_id = entry.name.split('_', 1)[0]
+                    conn.execute(
+                        "INSERT OR IGNORE INTO uploads (path, session_id, size, created_at) VALUES (?, ?, ?, ?)",
+                        (entry.path, session_id, stat.st_size, stat.st_mtime)
+                    )
+
+# Tiempo de vida de las subidas, cuota total en disco e intervalo del proceso de limpieza
+UPLOAD_MAX_AGE_SECONDS = int(os.environ.get('UPLOAD_MAX_AGE_SECONDS', 3600))
+UPLOAD_QUOTA_BYTES = int(os.environ.get('UPLOAD_QUOTA_BYTES', 1024 * 1024 * 1024))
+UPLOAD_REAPER_INTERVAL = int(os.environ.get('UPLOAD_REAPER_INTERVAL', 300))  # 0 lo desactiva
+# La base de datos vive fuera de UPLOAD_FOLDER: esa carpeta se sirve en /uploads/
+DATA_FOLDER = os.environ.get('DATA_FOLDER', 'data')
+os.makedirs(DATA_FOLDER, exist_ok=True)
+UPLOAD_INDEX_PATH = os.environ.get('UPLOAD_INDEX_PATH', os.path.join(DATA_FOLDER, 'index.sqlite3'))
+upload_index = UploadIndex(UPLOAD_INDEX_PATH)
+upload_index.reconcile(UPLOAD_FOLDER)
+
+class UploadSessionStore:
+    """Estado de cada portafolio en edición, guardado en el servidor.
+
+    Cada subida crea una entrada con un id opaco que viaja en los formularios
+    de edit.html; la cookie de Flask solo guarda el id del usuario (owner_id).
+    Así un mismo usuario puede editar varios portafolios a la vez (por ejemplo
+    en varias pestañas) y la cookie no crece con el número de imágenes.
+
+    Solo guarda el dueño y los títulos sugeridos: las imágenes y sus metadatos
+    están en el índice de subidas (UploadIndex.files). Los datos viven en
+    SQLite (compartido entre workers) con una caché en memoria delante cuyas
+    entradas duran UPLOAD_SESSION_CACHE_TTL segundos, así que los cambios
+    hechos por otro worker se ven, como mucho, con ese retraso.
+    """
+
+    def __init__(self, db_path, cache_size, cache_ttl):
+        self.db_path = db_path
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._lock = threading.Lock()
+        with connect_db(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS upload_sessions (
+                    id TEXT PRIMARY KEY,
+                    owner_id TEXT NOT NULL,
+                    titles TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+
+    def create(self, upload_id, owner_id):
+        """Registra un portafolio nuevo de este usuario"""
+        entry = {'owner_id': owner_id, 'titles': {}}
+        with connect_db(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO upload_sessions (id, owner_id, titles, created_at) VALUES (?, ?, ?, ?)",
+                (upload_id, owner_id, json.dumps(entry['titles']), time.time())
+            )
+        with self._lock:
+            self._cache[upload_id] = entry
+
+    def get(self, upload_id, owner_id):
+        """{'owner_id', 'titles'} del portafolio, o None si no existe o es de otro usuario"""
+        if not upload_id:
+            return None
+        with self._lock:
+            entry = self._cache.get(upload_id)
+        if entry is None:
+            with connect_db(self.db_path) as conn:
+                row = conn.execute(
+                    "SELECT owner_id, titles FROM upload_sessions WHERE id = ?", (upload_id,)
+                ).fetchone()
+            if row is None:
+                return None
+            entry = {'owner_id': row[0], 'titles': json.loads(row[1])}
+            with self._lock:
+                self._cache[upload_id] = entry
+        return entry if entry['owner_id'] == owner_id else None
+
+    def set_titles(self, upload_id, titles):
+        """Guarda los títulos {archivo: título} de un portafolio (se suman a los anteriores)"""
+        with connect_db(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT owner_id, titles FROM upload_sessions WHERE id = ?", (upload_id,)
+            ).fetchone()
+            if row is None:
+                return
+            entry = {'owner_id': row[0], 'titles': {**json.loads(row[1]), **titles}}
+            conn.execute(
+                "UPDATE upload_sessions SET titles = ? WHERE id = ?", (json.dumps(entry['titles']), upload_id)
+            )
+        with self._lock:
+            self._cache[upload_id] = entry
+
+    def delete(self, upload_id):
+        with connect_db(self.db_path) as conn:
+            conn.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+        with self._lock:
+            self._cache.pop(upload_id, None)
+
+    def expire(self, older_than):
+        """Borra los portafolios creados antes de older_than. Devuelve cuántos"""
+        with connect_db(self.db_path) as conn:
+            expired_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM upload_sessions WHERE created_at < ?", (older_than,)
+            )]
+            conn.executemany("DELETE FROM upload_sessions WHERE id = ?", [(upload_id,) for upload_id in expired_ids])
+        with self._lock:
+            for upload_id in expired_ids:
+                self._cache.pop(upload_id, None)
+        return len(expired_ids)
+
+UPLOAD_SESSION_CACHE_SIZE = int(os.environ.get('UPLOAD_SESSION_CACHE_SIZE', 1024))
+UPLOAD_SESSION_CACHE_TTL = int(os.environ.get('UPLOAD_SESSION_CACHE_TTL', 30))
+upload_sessions = UploadSessionStore(UPLOAD_INDEX_PATH, UPLOAD_SESSION_CACHE_SIZE, UPLOAD_SESSION_CACHE_TTL)
+
+def current_owner_id():
+    """Id del usuario guardado en la cookie (lo único que se guarda en ella)"""
+    if 'owner_id' not in session:
+        session['owner_id'] = uuid.uuid4().hex
+    return session['owner_id']
+
+class PdfJobStore:
+    """Estado de los trabajos de generación de PDF en segundo plano (SQLite).
+
+    Vive en la misma base de datos que el índice de subidas para que cualquier
+    worker de gunicorn pueda responder al progreso o a la descarga de un
+    trabajo, aunque lo esté ejecutando otro. Cada trabajo guarda el id del
+    usuario que lo creó y solo él puede consultarlo.
+
+    updated_at funciona como latido: el proceso que tiene el trabajo lo
+    renueva periódicamente, así que un trabajo 'queued' o 'running' cuyo
+    latido es antiguo se quedó huérfano (worker reiniciado o caído).
+    """
+
+    FIELDS = ('id', 'state', 'pages_done', 'pages_total', 'error', 'pdf_path', 'created_at', 'owner_id', 'updated_at')
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with connect_db(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pdf_jobs (
+                    id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    pages_done INTEGER NOT NULL DEFAULT 0,
+                    pages_total INTEGER NOT NULL,
+                    error TEXT,
+                    pdf_path TEXT,
+                    created_at REAL NOT NULL,
+                    owner_id TEXT,
+                    updated_at REAL
+                )
+            """)
+            # Bases de datos creadas antes de guardar el dueño y el latido de cada trabajo
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(pdf_jobs)")}
+            for name, column_type in (('owner_id', 'TEXT'), ('updated_at', 'REAL')):
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE pdf_jobs ADD COLUMN {name} {column_type}")
+
+    def create(self, job_id, pages_total, owner_id):
+        now = time.time()
+        with connect_db(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO pdf_jobs (id, state, pages_total, created_at, owner_id, updated_at)"
+                " VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, pages_total, now, owner_id, now)
+            )
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with connect_db(self.db_path) as conn:
+            conn.execute(f"UPDATE pdf_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def touch(self, job_ids):
+        """Renueva el latido de los trabajos que sigue teniendo este proceso"""
+        now = time.time()
+        with connect_db(self.db_path) as conn:
+            conn.executemany("UPDATE pdf_jobs SET updated_at = ? WHERE id = ?", [(now, job_id) for job_id in job_ids])
+
+    def fail_stale(self, older_than):
+        """Marca como fallidos los trabajos sin terminar cuyo latido es anterior a older_than. Devuelve cuántos"""
+        with connect_db(self.db_path) as conn:
+            cursor = conn.execute(
+                "UPDATE pdf_jobs SET state = 'error', error = ?, updated_at = ?"
+                " WHERE state IN ('queued', 'running') AND COALESCE(updated_at, created_at) < ?",
+                ("El servidor se reinició mientras se generaba el portafolio. Vuelve a intentarlo.",
+                 time.time(), older_than)
+            )
+            return cursor.rowcount
+
+    def get(self, job_id, owner_id):
+        """Diccionario con el estado del trabajo, o None si no existe o es de otro usuario"""
+        with connect_db(self.db_path) as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM pdf_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        job = dict(zip(self.FIELDS, row)) if row else None
+        return job if job and job['owner_id'] == owner_id else None
+
+    def expired(self, older_than):
+        """(id, ruta del PDF) de los trabajos creados antes de older_than"""
+        with connect_db(self.db_path) as conn:
+            return conn.execute(
+                "SELECT id, pdf_path FROM pdf_jobs WHERE created_at < ?", (older_than,)
+            ).fetchall()
+
+    def remove(self, job_ids):
+        with connect_db(self.db_path) as conn:
+            conn.executemany("DELETE FROM pdf_jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+# Carpeta donde quedan los PDFs terminados hasta que se descargan (o caducan)
+JOBS_FOLDER = os.environ.get('JOBS_FOLDER', 'jobs')
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+# Trabajos ejecutándose a la vez y trabajos en espera admitidos por proceso
+PDF_JOB_WORKERS = int(os.environ.get('PDF_JOB_WORKERS', 2))
+PDF_JOB_QUEUE_MAX = int(os.environ.get('PDF_JOB_QUEUE_MAX', 20))
+# Cada cuántos segundos renueva un proceso el latido de sus trabajos; sin latido
+# durante 4 intervalos, un trabajo sin terminar se da por perdido
+PDF_JOB_HEARTBEAT_SECONDS = float(os.environ.get('PDF_JOB_HEARTBEAT_SECONDS', 30))
+PDF_JOB_STALE_SECONDS = 4 * PDF_JOB_HEARTBEAT_SECONDS
+pdf_jobs = PdfJobStore(UPLOAD_INDEX_PATH)
+# Trabajos que dejó a medias un worker anterior (reinicio o despliegue)
+pdf_jobs.fail_stale(time.time() - PDF_JOB_STALE_SECONDS)
+pdf_job_pool = ThreadPoolExecutor(max_workers=PDF_JOB_WORKERS, thread_name_prefix='pdf-job')
+pdf_jobs_active = set()  # Ids de los trabajos encolados o en ejecución en este proceso
+pdf_jobs_lock = threading.Lock()
+
+def remove_upload_files(paths):
+    """Borra archivos subidos del disco y del índice. Devuelve cuántos se borraron"""
+    removed_count = 0
+    with timed_stage('file_delete'):
+        for filepath in paths:
+            try:
+                os.remove(filepath)
+                removed_count += 1
+                print(f"Archivo borrado: {os.path.basename(filepath)}")
+            except FileNotFoundError:
+                pass  # Otro worker ya lo borró
+            except Exception as e:
+                print(f"Error al borrar el archivo {os.path.basename(filepath)}: {e}")
+        upload_index.remove(paths)
+    return removed_count
+
+def remove_stale_temp_files(older_than):
+    """Borra los temporales huérfanos modificados antes de older_than. Devuelve cuántos.
+
+    Son subidas a medias (.upload-*.part) y derivados sin terminar (*.tmp) que
+    quedaron al caerse un worker; no están en ningún índice. Un archivo que se
+    sigue escribiendo tiene la fecha de modificación reciente y no se toca.
+    """
+    removed_count = 0
+    for folder, prefix, suffix in (
+        (app.config['UPLOAD_FOLDER'], '.upload-', '.part'),
+        (derivative_cache.folder, '', '.tmp'),
+    ):
+        for entry in os.scandir(folder):
+            if not (entry.name.startswith(prefix) and entry.name.endswith(suffix)):
+                continue
+            try:
+                if entry.stat().st_mtime < older_than:
+                    os.remove(entry.path)
+                    removed_count += 1
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error al borrar el temporal {entry.name}: {e}")
+    return removed_count
+
 def cleanup_old_files():
-    """Limpia archivos antiguos de la carpeta uploads (más de 1 hora)"""
-    import time
-    current_time = time.time()
-    image_dir = app.config['UPLOAD_FOLDER']
-    
-    if not os.path.exists(image_dir):
-        return
-    
-    for filename in os.listdir(image_dir):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            filepath = os.path.join(image_dir, filename)
+    """Limpia archivos antiguos (más de UPLOAD_MAX_AGE_SECONDS) y los que superan la cuota.
+
+    Para las subidas solo consulta el índice; de la carpeta uploads únicamente
+    se recorren los temporales huérfanos.
+    """
+    expired = upload_index.expired(time.time() - UPLOAD_MAX_AGE_SECONDS)
+    over_quota = upload_index.over_quota(UPLOAD_QUOTA_BYTES)
+    removed_count = remove_upload_files(list(dict.fromkeys(expired + over_quota)))
+    metrics.inc('portfolio_files_reaped_total', removed_count)
+
+    # Borrar los PDFs de trabajos antiguos que nadie descargó
+    expired_jobs = pdf_jobs.expired(time.time() - UPLOAD_MAX_AGE_SECONDS)
+    for job_id, pdf_path in expired_jobs:
+        if pdf_path:
             try:
-                # Si el archivo es más antiguo que 1 hora, lo elimina
-                if current_time - os.path.getmtime(filepath) > 3600:
-                    os.remove(filepath)
-                    print(f"Archivo antiguo eliminado: {filename}")
+                os.remove(pdf_path)
+            except FileNotFoundError:
+                pass
             except Exception as e:
-                print(f"Error al eliminar archivo antiguo {filename}: {e}")
+                print(f"Error al borrar el PDF del trabajo {job_id}: {e}")
+    pdf_jobs.remove([job_id for job_id, _ in expired_jobs])
+
+    # Y los portafolios en edición cuyas imágenes ya caducaron
+    upload_sessions.expire(time.time() - UPLOAD_MAX_AGE_SECONDS)
+
+    # Temporales que dejaron subidas interrumpidas o workers caídos
+    remove_stale_temp_files(time.time() - UPLOAD_MAX_AGE_SECONDS)
+
+    # Mantener la caché de derivados dentro de su límite de tamaño
+    derivative_cache.trim()
+    return removed_count
+
+def run_upload_reaper(stop_event):
+    """Bucle del hilo de limpieza: ejecuta cleanup_old_files cada UPLOAD_REAPER_INTERVAL segundos"""
+    while not stop_event.wait(UPLOAD_REAPER_INTERVAL):
+        try:
+            cleanup_old_files()
+        except Exception as e:
+            print(f"Error en la limpieza programada: {e}")
+
+upload_reaper_stop = threading.Event()
+if UPLOAD_REAPER_INTERVAL > 0:
+    threading.Thread(target=run_upload_reaper, args=(upload_reaper_stop,), name='upload-reaper', daemon=True).start()
+
+def compute_image_box(img_width, img_height):
+    """Calcula el tamaño (en mm) que ocupa una imagen dentro de la página A4"""
+    ratio = img_width / img_height
+
+    if ratio > 1:
+        pdf_w = PDF_WIDTH * 0.9
+        pdf_h = pdf_w / ratio
+    else:
+        pdf_h = PDF_HEIGHT * 0.9
+        pdf_w = pdf_h * ratio
+
+    return pdf_w, pdf_h
+
+# Perfil de destino de las imágenes recodificadas (el que asumen visores y PDFs sin perfil)
+SRGB_PROFILE = ImageCms.createProfile('sRGB')
+
+def encode_image(img, target_size, quality):
+    """Reduce una imagen abierta con PIL a target_size y la devuelve codificada.
+
+    Devuelve (bytes, extensión). Las imágenes con transparencia se mantienen en
+    PNG, el resto pasa a JPEG. La orientación EXIF se aplica a los píxeles y, si
+    la imagen trae un perfil de color (por ejemplo Display P3), se convierte a
+    sRGB; el resultado se guarda sin metadatos. target_size es el tamaño tal
+    como se ve la imagen (ya girada).
+    """
+    # En JPEG, draft() decodifica directamente a una escala reducida (mucho más rápido);
+    # trabaja sobre los píxeles del archivo, antes de girarlos
+    width, height = target_size
+    img.draft('RGB', (height, width) if is_rotated(img) else target_size)
+
+    icc_profile = img.info.get('icc_profile')
+    # Los navegadores respetan la orientación EXIF: sin aplicarla, las fotos verticales saldrían tumbadas
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    clean = img.convert('RGBA' if has_alpha else 'RGB')
+    clean.thumbnail(target_size, Image.LANCZOS)  # Nunca amplía
+    if icc_profile:
+        # Sin el perfil los colores se interpretarían como sRGB: hay que convertirlos
+        try:
+            clean = ImageCms.profileToProfile(
+                clean, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)), SRGB_PROFILE, outputMode=clean.mode
+            )
+        except (ImageCms.PyCMSError, OSError) as e:
+            print(f"No se pudo convertir el perfil de color a sRGB: {e}")
+    clean.info = {}  # Quitar metadatos (EXIF, ICC...)
+
+    data = io.BytesIO()
+    if has_alpha:
+        clean.save(data, 'PNG', compress_level=PDF_PNG_COMPRESS_LEVEL)
+        return data.getvalue(), 'png'
+    clean.save(data, 'JPEG', quality=quality, optimize=True)
+    return data.getvalue(), 'jpg'
+
+def preprocess_image(filepath, dimensions=None):
+    """Devuelve la versión de una imagen lista para el PDF y su caja en mm.
+
+    La versión reducida a PDF_IMAGE_DPI se guarda en la caché de derivados, así
+    que la misma imagen solo se decodifica y redimensiona una vez por preset.
+    Si ya se conocen las dimensiones originales (de la subida), no se vuelve a
+    leer ninguna cabecera para calcular la caja.
+    """
+    key = derivative_cache.key_for(filepath)
+    preset = f"pdf{PDF_IMAGE_DPI}dpi_q{PDF_JPEG_QUALITY}"
+
+    rendition_path = derivative_cache.get(key, preset)
+    if rendition_path is None:
+        with timed_stage('image_preprocess'), Image.open(filepath) as img:
+            pdf_w, pdf_h = compute_image_box(*oriented_size(img))
+            # Píxeles necesarios para la caja a la resolución objetivo
+            target_size = (
+                max(1, round(pdf_w / 25.4 * PDF_IMAGE_DPI)),
+                max(1, round(pdf_h / 25.4 * PDF_IMAGE_DPI)),
+            )
+            data, ext = encode_image(img, target_size, PDF_JPEG_QUALITY)
+        rendition_path = derivative_cache.put(key, preset, ext, data)
+
+    if dimensions:
+        pdf_w, pdf_h = compute_image_box(*dimensions)
+    else:
+        # Solo lee la cabecera de la versión reducida (no la decodifica)
+        with Image.open(rendition_path) as img:
+            pdf_w, pdf_h = compute_image_box(*img.size)
+
+    return {'data': rendition_path, 'pdf_w': pdf_w, 'pdf_h': pdf_h}
+
+def get_thumbnail(filepath):
+    """Devuelve la ruta de la miniatura de una imagen subida (creándola si hace falta)"""
+    key = derivative_cache.key_for(filepath)
+
+    thumbnail_path = derivative_cache.get(key, 'thumb')
+    if thumbnail_path is None:
+        with timed_stage('thumbnail'), Image.open(filepath) as img:
+            data, ext = encode_image(img, THUMBNAIL_SIZE, THUMBNAIL_QUALITY)
+        thumbnail_path = derivative_cache.put(key, 'thumb', ext, data)
+
+    return thumbnail_path
+
+def build_portfolio_pdf(image_dir, image_files_to_process, form, on_progress=None, known_dimensions=None):
+    """Construye el PDF del portafolio y lo devuelve en un buffer listo para enviar.
+
+    Cada petición usa su propio buffer, así que varios workers pueden generar
+    portafolios al mismo tiempo sin pisarse el archivo de salida. Si se indica
+    on_progress, se llama con (páginas hechas, total) después de cada imagen.
+    known_dimensions ({ruta: (ancho, alto)}) evita consultar el índice de subidas.
+    """
+    # 1. Preprocesar todas las imágenes en paralelo (el orden se conserva con la lista de futures)
+    filepaths = [os.path.join(image_dir, filename) for filename in image_files_to_process]
+    if known_dimensions is None:
+        known_dimensions = upload_index.dimensions(filepaths)
+    futures = [
+        image_preprocess_pool.submit(preprocess_image, filepath, known_dimensions.get(filepath))
+        for filepath in filepaths
+    ]
+
+    # Inicializar el objeto PDF
+    pdf = FPDF()
+    # 2. Procesar cada imagen
+    for page_number, (filename, future) in enumerate(zip(image_files_to_process, futures), start=1): # Usamos la lista REAL de archivos
+        # Obtener el nombre base del archivo (sin el ID de sesión)
+        base_filename = filename.split('_', 1)[1] if '_' in filename else filename
+    
+        # 1. Obtener el título que el usuario escribió para esta imagen
+        title_field_name = f'title_{base_filename}'
+        user_title = form.get(title_field_name, "Portafolio de Imágenes (Sin Título)") # Obtiene el texto del formulario
+    
+        # Intenta agregar la imagen y el título al PDF
+        try:
+            # 2. Imagen ya redimensionada y recodificada por el pool (la espera se mide aparte)
+            with timed_stage('image_wait'):
+                prepared = future.result()
+            pdf_w = prepared['pdf_w']
+            pdf_h = prepared['pdf_h']
+            
+            x = (PDF_WIDTH - pdf_w) / 2
+        
+            with timed_stage('pdf_layout'):
+                # 3. Agregar la página y la imagen
+                pdf.add_page()
+            
+                # 4. Agregar el TÍTULO (fijado en la parte superior)
+                pdf.set_xy(10, 10) # Fija la posición muy cerca de la esquina superior izquierda
+                pdf.set_font('Arial', 'B', 16) 
+                pdf.set_text_color(20, 20, 20)
+                pdf.cell(0, 10, user_title, 0, 1, 'C') # 0: ancho total, C: CENTRADO
+
+                # AGREGAR SALTO DE LÍNEA GRANDE para que la imagen no toque el título
+                pdf.ln(15) 
+            
+                # Resto de la lógica de la imagen
+                pdf.image(prepared['data'], x, pdf.get_y(), pdf_w, pdf_h) # Usamos pdf.get_y() para la coordenada y
+            metrics.inc('portfolio_pdf_pages_rendered_total')
+        
+        except Exception as e:
+            # MANTENER: El bloque de error original
+            print(f"Error al procesar la imagen {base_filename}: {e}")
+
+        if on_progress:
+            on_progress(page_number, len(image_files_to_process))
+
+    # 3. Volcar el PDF a un buffer propio de la petición (fpdf2 lo genera entero en memoria)
+    with timed_stage('pdf_output'):
+        pdf_buffer = io.BytesIO(pdf.output())
+    metrics.inc('portfolio_pdfs_built_total')
+    return pdf_buffer
+
+def enqueue_pdf_job(owner_id, image_dir, image_files_to_process, form, known_dimensions=None, upload_id=None):
+    """Encola la generación de un PDF y devuelve el id del trabajo (None si la cola está llena).
+
+    Solo owner_id puede consultar el trabajo y descargar el PDF. upload_id es
+    el portafolio en edición que se borra cuando el PDF está listo.
+    """
+    job_id = str(uuid.uuid4())
+    with pdf_jobs_lock:
+        if len(pdf_jobs_active) >= PDF_JOB_QUEUE_MAX:
+            return None
+        pdf_jobs_active.add(job_id)
+
+    pdf_jobs.create(job_id, len(image_files_to_process), owner_id)
+    pdf_job_pool.submit(run_pdf_job, job_id, image_dir, image_files_to_process, form, known_dimensions, upload_id)
+    return job_id
+
+def run_pdf_job(job_id, image_dir, image_files_to_process, form, known_dimensions=None, upload_id=None):
+    """Ejecuta un trabajo del pool: genera el PDF, lo guarda en JOBS_FOLDER y borra las subidas.
+
+    Si falla, las subidas y el portafolio se conservan para poder reintentarlo.
+    """
+    try:
+        # Comparte el límite de PDFs simultáneos con las peticiones normales
+        with pdf_build_slots:
+            # Mientras espera turno el trabajo sigue 'queued'
+            pdf_jobs.update(job_id, state='running')
+            pdf_buffer = build_portfolio_pdf(
+                image_dir, image_files_to_process, form,
+                on_progress=lambda done, total: pdf_jobs.update(job_id, pages_done=done),
+                known_dimensions=known_dimensions
+            )
+
+        pdf_path = os.path.abspath(os.path.join(JOBS_FOLDER, f"{job_id}.pdf"))
+        with pdf_buffer, open(pdf_path, 'wb') as f:
+            shutil.copyfileobj(pdf_buffer, f)
+
+        remove_upload_files([os.path.join(image_dir, filename) for filename in image_files_to_process])
+        if upload_id:
+            upload_sessions.delete(upload_id)
+        pdf_jobs.update(job_id, state='done', pdf_path=pdf_path)
+    except Exception as e:
+        print(f"Error en el trabajo de PDF {job_id}: {e}")
+        pdf_jobs.update(job_id, state='error', error=str(e))
+    finally:
+        with pdf_jobs_lock:
+            pdf_jobs_active.discard(job_id)
+
+def run_pdf_job_heartbeat(stop_event):
+    """Bucle del hilo de latido: renueva los trabajos de este proceso y da por fallidos los huérfanos"""
+    while not stop_event.wait(PDF_JOB_HEARTBEAT_SECONDS):
+        try:
+            with pdf_jobs_lock:
+                active_jobs = list(pdf_jobs_active)
+            pdf_jobs.touch(active_jobs)
+            pdf_jobs.fail_stale(time.time() - PDF_JOB_STALE_SECONDS)
+        except Exception as e:
+            print(f"Error en el latido de los trabajos de PDF: {e}")
+
+pdf_job_heartbeat_stop = threading.Event()
+threading.Thread(
+    target=run_pdf_job_heartbeat, args=(pdf_job_heartbeat_stop,), name='pdf-job-heartbeat', daemon=True
+).start()
+
+# --- LLAMADAS A GEMINI (caché, peticiones agrupadas, límite de ritmo y reintentos) ---
+
+class GeminiRateLimited(Exception):
+    """No hubo turno libre en el limitador de peticiones a Gemini"""
+
+class TokenBucket:
+    """Limitador de ritmo: permite 'rate' peticiones por segundo con ráfagas de hasta 'capacity'"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """Consume un turno; espera hasta 'timeout' segundos. Devuelve False si no lo consigue"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(wait, remaining))
+
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.5-flash')
+# Respuestas guardadas en memoria: cuántas y durante cuántos segundos
+GEMINI_CACHE_SIZE = int(os.environ.get('GEMINI_CACHE_SIZE', 256))
+GEMINI_CACHE_TTL_SECONDS = int(os.environ.get('GEMINI_CACHE_TTL_SECONDS', 3600))
+# Peticiones por segundo (y ráfaga máxima) que este proceso envía a Gemini
+GEMINI_RATE_PER_SECOND = float(os.environ.get('GEMINI_RATE_PER_SECOND', 1))
+GEMINI_RATE_BURST = int(os.environ.get('GEMINI_RATE_BURST', 5))
+if GEMINI_RATE_PER_SECOND <= 0 or GEMINI_RATE_BURST < 1:
+    raise ValueError("GEMINI_RATE_PER_SECOND debe ser mayor que 0 y GEMINI_RATE_BURST al menos 1")
+GEMINI_RATE_LIMIT_WAIT_SECONDS = float(os.environ.get('GEMINI_RATE_LIMIT_WAIT_SECONDS', 5))
+# Reintentos con espera exponencial ante errores temporales (429, 5xx, timeouts)
+GEMINI_MAX_ATTEMPTS = int(os.environ.get('GEMINI_MAX_ATTEMPTS', 3))
+GEMINI_RETRY_INITIAL_SECONDS = float(os.environ.get('GEMINI_RETRY_INITIAL_SECONDS', 1))
+GEMINI_RETRY_MAX_SECONDS = float(os.environ.get('GEMINI_RETRY_MAX_SECONDS', 8))
+
+gemini_cache = TTLCache(maxsize=GEMINI_CACHE_SIZE, ttl=GEMINI_CACHE_TTL_SECONDS)
+gemini_inflight = {}  # clave -> Future de la llamada que ya está en curso
+gemini_lock = threading.Lock()
+gemini_rate_limiter = TokenBucket(GEMINI_RATE_PER_SECOND, GEMINI_RATE_BURST)
+
+def normalize_prompt(prompt):
+    """Normaliza espacios para que el mismo texto comparta entrada en la caché"""
+    return " ".join(prompt.split())
+
+def is_retryable_gemini_error(error):
+    """Errores temporales que merece la pena reintentar"""
+    code = getattr(error, 'code', None)  # google.genai.errors.APIError
+    if isinstance(code, int):
+        return code == 429 or code >= 500
+    return isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError))
+
+def call_gemini(client, model, contents, config=None):
+    """Llama a generate_content respetando el límite de ritmo y con reintentos.
+
+    Devuelve el texto de la respuesta.
+    """
+    kwargs = {'config': config} if config is not None else {}
+    retrying = Retrying(
+        stop=stop_after_attempt(GEMINI_MAX_ATTEMPTS),
+        wait=wait_exponential_jitter(initial=GEMINI_RETRY_INITIAL_SECONDS, max=GEMINI_RETRY_MAX_SECONDS),
+        retry=retry_if_exception(is_retryable_gemini_error),
+        reraise=True
+    )
+    for attempt in retrying:
+        with attempt:
+            if not gemini_rate_limiter.acquire(timeout=GEMINI_RATE_LIMIT_WAIT_SECONDS):
+                raise GeminiRateLimited("Demasiadas peticiones al Asistente de IA. Inténtalo de nuevo en unos segundos.")
+            response = client.models.generate_content(model=model, contents=contents, **kwargs)
+            return response.text.strip()
+
+def generate_text(prompt, model=GEMINI_MODEL):
+    """Genera texto con Gemini usando la caché y agrupando peticiones idénticas.
+
+    Si la misma instrucción (normalizada) ya está en la caché se devuelve sin
+    llamar a la API; si otra petición la está pidiendo en ese momento, se
+    espera a su resultado en lugar de hacer una segunda llamada. Usa el
+    gemini_client del módulo, que puede sustituirse por un cliente falso.
+    """
+    return coalesced_gemini_call((model, normalize_prompt(prompt)), model, prompt)
+
+def coalesced_gemini_call(key, model, contents, config=None):
+    """Hace la llamada a Gemini una sola vez por clave: usa la caché o espera a la llamada en curso"""
+    with gemini_lock:
+        if key in gemini_cache:
+            metrics.inc('portfolio_gemini_requests_total', result='cache_hit')
+            return gemini_cache[key]
+        future = gemini_inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = gemini_inflight[key] = Future()
+
+    if not is_leader:
+        # Tiempo máximo que puede tardar la llamada que ya está en curso
+        max_wait = GEMINI_MAX_ATTEMPTS * (GEMINI_TIMEOUT_SECONDS + GEMINI_RETRY_MAX_SECONDS + GEMINI_RATE_LIMIT_WAIT_SECONDS)
+        metrics.inc('portfolio_gemini_requests_total', result='coalesced')
+        return future.result(timeout=max_wait)
+
+    try:
+        with timed_stage('gemini_call'):
+            text = call_gemini(gemini_client, model, contents, config)
+        metrics.inc('portfolio_gemini_requests_total', result='ok')
+    except Exception as e:
+        metrics.inc('portfolio_gemini_requests_total', result='error')
+        future.set_exception(e)
+        raise
+    else:
+        with gemini_lock:
+            gemini_cache[key] = text
+        future.set_result(text)
+        return text
+    finally:
+        with gemini_lock:
+            gemini_inflight.pop(key, None)
+
+class ImageTitle(BaseModel):
+    """Título sugerido por la IA para una imagen"""
+    filename: str
+    title: str
+
+class ImageTitles(BaseModel):
+    """Respuesta estructurada de la generación de títulos por lotes"""
+    titles: list[ImageTitle]
+
+def generate_image_titles(filepaths, user_prompt="", model=GEMINI_MODEL):
+    """Pide a Gemini un título para cada imagen en una sola llamada multimodal.
+
+    Se envían las miniaturas (no los originales) junto con el nombre de cada
+    archivo y la respuesta se valida contra el esquema ImageTitles. Devuelve
+    {ruta: título}. La caché usa el hash de cada imagen, así que repetir la
+    petición con las mismas imágenes no vuelve a llamar a la API.
+    """
+    contents = [f"""
+    Eres un experto en branding y diseño de portafolios.
+    Escribe un título corto, llamativo y elegante para cada una de las imágenes
+    siguientes, que forman parte de un mismo portafolio.
+    Instrucción del usuario (puede estar vacía): "{user_prompt}"
+
+    Devuelve un título por imagen usando exactamente el nombre de archivo indicado.
+    """]
+    names = {}
+    image_keys = []
+    # Las miniaturas que no están en la caché se generan en paralelo, como en build_portfolio_pdf
+    thumbnail_futures = [image_preprocess_pool.submit(get_thumbnail, filepath) for filepath in filepaths]
+    for filepath, future in zip(filepaths, thumbnail_futures):
+        base_filename = os.path.basename(filepath).split('_', 1)[-1]
+        thumbnail_path = future.result()
+        with open(thumbnail_path, 'rb') as f:
+            thumbnail = f.read()
+        mime_type = 'image/png' if thumbnail_path.endswith('.png') else 'image/jpeg'
+
+        contents.append(f"Archivo: {base_filename}")
+        contents.append(types.Part.from_bytes(data=thumbnail, mime_type=mime_type))
+        names[base_filename] = filepath
+        image_keys.append((base_filename, derivative_cache.key_for(filepath)))
+
+    config = types.GenerateContentConfig(response_mime_type='application/json', response_schema=ImageTitles)
+    key = (model, 'image_titles', normalize_prompt(user_prompt), tuple(image_keys))
+    result = ImageTitles.model_validate_json(coalesced_gemini_call(key, model, contents, config))
+
+    return {names[item.filename]: item.title for item in result.titles if item.filename in names}
 
 # --- RUTAS DE LA APLICACIÓN ---
 
+def render_edit_page(upload_id, upload, **context):
+    """Muestra edit.html para un portafolio del almacén de sesiones de subida"""
+    return render_template(
+        'edit.html',
+        upload_id=upload_id,
+        filenames=[image['filename'] for image in upload_index.files(upload_id)],
+        suggested_titles=upload['titles'],
+        **context
+    )
+
+def owned_upload_path(filename):
+    """Ruta de un archivo subido a un portafolio de este usuario (404 si no lo es)"""
+    filepath = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if filepath is None or not allowed_file(filename):
+        abort(404)
+    session_id = upload_index.session_of(filepath)
+    if session_id is None or upload_sessions.get(session_id, current_owner_id()) is None:
+        abort(404)
+    return filepath
+
+def private_response(response):
+    """Las imágenes de un usuario no deben quedar en cachés compartidas (proxies, CDN)"""
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+def upload_not_found():
+    return render_template(
+        'message.html',
+        title="Sesión de subida no encontrada",
+        message="Las imágenes de este portafolio ya no están disponibles (caducaron o ya se generó el PDF). Vuelve a subirlas."
+    ), 404
+
 # 1. Ruta principal: Muestra el formulario (archivo index.html)
 @app.route('/')
 def index():
-    # Limpiar archivos antiguos al cargar la página principal
-    cleanup_old_files()
+    # La limpieza de archivos antiguos la hace el hilo upload-reaper en segundo plano
     # Esto carga el archivo HTML con el formulario de subida
     return render_template('index.html') 
 
 # 2. Ruta de Subida: Procesa los archivos del formulario
 @app.route('/upload', methods=['POST'])
 def upload_files():
-    if 'file' not in request.files:
+    # Al acceder a request.files se lee la petición y cada archivo se escribe en disco (UploadSpool)
+    with timed_stage('upload_receive'):
+        has_files = 'file' in request.files
+    if not has_files:
         return redirect(request.url) 
 
     files = request.files.getlist('file')
     uploaded_filenames = []
+    rejected_files = []  # (nombre, motivo) de los archivos descartados al subir
     
-    # Generar un ID único para esta sesión de subida
-    import uuid
+    # Generar un ID único para esta sesión de subida (viaja en los formularios, no en la cookie)
     session_id = str(uuid.uuid4())
-    session['current_upload_id'] = session_id
-
-    for file in files:
-        if file and allowed_file(file.filename):
-            # Crear nombre único para evitar conflictos
-            original_filename = secure_filename(file.filename)
-            name, ext = os.path.splitext(original_filename)
-            filename = f"{session_id}_{name}{ext}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            uploaded_filenames.append(filename)
-
-    # Guardar la lista de archivos en la sesión
-    session['uploaded_files'] = uploaded_filenames
+
+    with timed_stage('upload_save'):
+        for file in files:
+            if file and allowed_file(file.filename):
+                # Crear nombre único para evitar conflictos
+                original_filename = secure_filename(file.filename)
+                name, ext = os.path.splitext(original_filename)
+                filename = f"{session_id}_{name}{ext}"
+                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+                # El archivo ya está en disco (UploadSpool); solo se valida y se renombra
+                spool = file.stream
+                if spool.error:
+                    rejected_files.append((original_filename, spool.error))
+                    continue
+                if spool.dimensions is None:
+                    rejected_files.append((original_filename, "no es una imagen válida"))
+                    spool.close()
+                    continue
+                spool.commit(filepath)
+                derivative_cache.remember(filepath, spool.content_hash)
+                upload_index.add(session_id, filepath, spool.size, spool.image_format, spool.dimensions)
+                uploaded_filenames.append(filename)
+                metrics.inc('portfolio_uploaded_bytes_total', spool.size)
+    metrics.inc('portfolio_uploaded_files_total', len(uploaded_filenames), result='accepted')
+    metrics.inc('portfolio_uploaded_files_total', len(rejected_files), result='rejected')
+
+    # Registrar el portafolio en el almacén del servidor (las imágenes ya están en el índice)
+    upload_sessions.create(session_id, current_owner_id())
     
     # Redirige a la página de edición (edit.html)
-    return render_template('edit.html', filenames=uploaded_filenames)
+    return render_edit_page(session_id, upload_sessions.get(session_id, current_owner_id()), rejected_files=rejected_files)
 
 # 3. Ruta para servir los archivos subidos (hace que las imágenes sean visibles al navegador)
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Solo imágenes de un portafolio de este usuario (nada de .part ni otros archivos de la carpeta)
+    owned_upload_path(filename)
+    # Ruta absoluta: Flask resolvería una relativa desde la carpeta de app.py, no desde el directorio de trabajo
+    return private_response(send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename))
+
+# 3b. Ruta para las miniaturas de la página de edición (más ligeras que el original)
+@app.route('/thumbnails/<filename>')
+def thumbnail_file(filename):
+    filepath = owned_upload_path(filename)
+    if not os.path.isfile(filepath):
+        abort(404)
+
+    try:
+        thumbnail_path = get_thumbnail(filepath)
+    except Exception as e:
+        # No es una imagen que se pueda leer: no se sirve nada en su lugar
+        print(f"Error al generar la miniatura de {filename}: {e}")
+        abort(404)
+
+    return private_response(send_file(thumbnail_path, max_age=3600))
 
 # 4. Ruta para generar el PDF
 @app.route('/create-pdf', methods=['POST'])
 def create_pdf():
-    # Obtener el ID de sesión único del usuario
-    session_id = session.get('current_upload_id')
-    if not session_id:
+    # Obtener el portafolio indicado en el formulario (debe ser de este usuario)
+    session_id = request.form.get('upload_id')
+    upload = upload_sessions.get(session_id, current_owner_id())
+    if upload is None:
         return "Error: No se encontró la sesión de subida.", 400
 
     # Obtener las imágenes seleccionadas del formulario (solo nombres originales sin ID)
@@ -121,85 +1447,85 @@ def create_pdf():
     image_dir = app.config['UPLOAD_FOLDER']
     image_files_to_process = [] # Lista de nombres de archivos completos (con ID)
 
-    # 1. Reconstruir los nombres de archivos REALES usando el ID de sesión
+    # 1. Buscar los archivos REALES en el índice (solo se aceptan imágenes de este portafolio)
+    uploaded_images = upload_index.files(session_id)
+    images_by_name = {image['name']: image for image in uploaded_images}
     for original_name in selected_images:
-        # El nombre del archivo en el servidor es: ID_original.ext
-        # No usamos secure_filename porque el original_name ya está seguro (viene del formulario)
-        full_filename = f"{session_id}_{original_name}"
-        image_files_to_process.append(full_filename)
+        if original_name in images_by_name:
+            image_files_to_process.append(images_by_name[original_name]['filename'])
+    if not image_files_to_process:
+        return "No hay imágenes seleccionadas para generar el PDF.", 400
 
-    # Inicializar el objeto PDF
-    pdf = FPDF()
-    PDF_WIDTH = 210
-    PDF_HEIGHT = 297
+    # Dimensiones guardadas al subir: no hace falta volver a abrir los originales
+    known_dimensions = {
+        os.path.join(image_dir, image['filename']): (image['width'], image['height'])
+        for image in uploaded_images if image['width']
+    }
+
+    # Modo trabajo: se encola la generación y se responde al momento con el id
+    if request.form.get('mode') == 'job':
+        job_id = enqueue_pdf_job(
+            current_owner_id(), image_dir, image_files_to_process, request.form.to_dict(), known_dimensions, upload_id=session_id
+        )
+        if job_id is None:
+            return jsonify(error="Hay demasiados portafolios en cola. Inténtalo de nuevo en unos minutos."), 503
+
+        # El portafolio se borra al terminar el trabajo (run_pdf_job), no ahora: si falla se puede reintentar
+        return jsonify(
+            job_id=job_id,
+            status_url=url_for('pdf_job_status', job_id=job_id),
+            download_url=url_for('pdf_job_download', job_id=job_id)
+        ), 202
+
+    # Esperar un turno libre: limita cuántos PDFs se construyen a la vez
+    if not pdf_build_slots.acquire(timeout=PDF_BUILD_WAIT_SECONDS):
+        return "El servidor está generando otros portafolios. Inténtalo de nuevo en unos segundos.", 503
+    try:
+        pdf_buffer = build_portfolio_pdf(image_dir, image_files_to_process, request.form, known_dimensions=known_dimensions)
+    finally:
+        pdf_build_slots.release()
 
-    # 2. Procesar cada imagen
-    for filename in image_files_to_process: # Usamos la lista REAL de archivos
-        filepath = os.path.join(image_dir, filename)
-        
-        # Obtener el nombre base del archivo (sin el ID de sesión)
-        base_filename = filename.split('_', 1)[1] if '_' in filename else filename
-        
-        # 1. Obtener el título que el usuario escribió para esta imagen
-        title_field_name = f'title_{base_filename}'
-        user_title = request.form.get(title_field_name, "Portafolio de Imágenes (Sin Título)") # Obtiene el texto del formulario
-        
-        # Intenta agregar la imagen y el título al PDF
-        try:
-            # 2. Lógica de Redimensionamiento (similar a la que tenías)
-            img = Image.open(filepath)
-            img_width, img_height = img.size
-            ratio = img_width / img_height
-            
-            if ratio > 1:
-                pdf_w = PDF_WIDTH * 0.9
-                pdf_h = pdf_w / ratio
-            else:
-                pdf_h = PDF_HEIGHT * 0.9
-                pdf_w = pdf_h * ratio
-                
-            x = (PDF_WIDTH - pdf_w) / 2
-            y = (PDF_HEIGHT - pdf_h) / 2
-            
-            # 3. Agregar la página y la imagen
-            pdf.add_page()
-            
-            # 4. Agregar el TÍTULO (fijado en la parte superior)
-            pdf.set_xy(10, 10) # Fija la posición muy cerca de la esquina superior izquierda
-            pdf.set_font('Arial', 'B', 16) 
-            pdf.set_text_color(20, 20, 20)
-            pdf.cell(0, 10, user_title, 0, 1, 'C') # 0: ancho total, C: CENTRADO
-
-            # AGREGAR SALTO DE LÍNEA GRANDE para que la imagen no toque el título
-            pdf.ln(15) 
-            
-            # Resto de la lógica de la imagen
-            pdf.image(filepath, x, pdf.get_y(), pdf_w, pdf_h) # Usamos pdf.get_y() para la coordenada y
-            
-        except Exception as e:
-            # MANTENER: El bloque de error original
-            print(f"Error al procesar la imagen {base_filename}: {e}")
-            
-    # 3. Guardar el PDF en un archivo temporal
-    output_pdf_path = os.path.join('temp_portfolio.pdf')
-    pdf.output(output_pdf_path)
-    
     # --- CÓDIGO DE LIMPIEZA FINAL: Solo borra los archivos usados por ESTA sesión ---
-    for filename in image_files_to_process:
-        filepath = os.path.join(image_dir, filename)
-        try:
-            os.remove(filepath)
-            print(f"Archivo borrado: {filename}")
-        except Exception as e:
-            print(f"Error al borrar el archivo {filename}: {e}")
+    remove_upload_files([os.path.join(image_dir, filename) for filename in image_files_to_process])
             
-    # Limpiar la sesión después de generar el PDF
-    session.pop('uploaded_files', None)
-    session.pop('current_upload_id', None)
+    # Limpiar la sesión de subida después de generar el PDF
+    upload_sessions.delete(session_id)
             
-    # Enviar el archivo PDF al navegador
+    # Enviar el PDF al navegador directamente desde el buffer de esta petición
+    return send_file(
+        pdf_buffer,
+        as_attachment=True,
+        download_name='Portafolio_IA.pdf',
+        mimetype='application/pdf'
+    )
+
+# 4b. Progreso de un trabajo de PDF (páginas hechas / total)
+@app.route('/jobs/<job_id>')
+def pdf_job_status(job_id):
+    job = pdf_jobs.get(job_id, current_owner_id())
+    if job is None:
+        return jsonify(error="Trabajo no encontrado."), 404
+
+    return jsonify(
+        job_id=job['id'],
+        state=job['state'],  # queued, running, done o error
+        pages_done=job['pages_done'],
+        pages_total=job['pages_total'],
+        error=job['error'],
+        download_url=url_for('pdf_job_download', job_id=job_id) if job['state'] == 'done' else None
+    )
+
+# 4c. Descarga del PDF de un trabajo terminado
+@app.route('/jobs/<job_id>/download')
+def pdf_job_download(job_id):
+    job = pdf_jobs.get(job_id, current_owner_id())
+    if job is None:
+        return "Trabajo no encontrado.", 404
+    if job['state'] != 'done':
+        return "El portafolio todavía no está listo.", 409
+
     return send_file(
-        output_pdf_path,
+        job['pdf_path'],
         as_attachment=True,
         download_name='Portafolio_IA.pdf',
         mimetype='application/pdf'
@@ -208,21 +1534,13 @@ def create_pdf():
 # 5. Ruta para limpiar todas las imágenes (opcional)
 @app.route('/cleanup', methods=['POST'])
 def cleanup_all():
-    """Limpia todas las imágenes de la carpeta uploads"""
-    image_dir = app.config['UPLOAD_FOLDER']
-    
-    if not os.path.exists(image_dir):
+    """Limpia todas las imágenes de la carpeta uploads (según el índice de subidas)"""
+    paths = upload_index.all_paths()
+
+    if not paths:
         return "No hay archivos para limpiar", 200
     
-    removed_count = 0
-    for filename in os.listdir(image_dir):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            filepath = os.path.join(image_dir, filename)
-            try:
-                os.remove(filepath)
-                removed_count += 1
-            except Exception as e:
-                print(f"Error al eliminar {filename}: {e}")
+    removed_count = remove_upload_files(paths)
     
     return f"Se eliminaron {removed_count} archivos", 200
 
@@ -230,15 +1548,18 @@ def cleanup_all():
 @app.route('/generate-ia', methods=['POST'])
 def generate_ia():
     user_prompt = request.form.get('ia_prompt')
-    current_filenames = session.get('uploaded_files', [])
+    upload_id = request.form.get('upload_id')
+    upload = upload_sessions.get(upload_id, current_owner_id())
+    if upload is None:
+        return upload_not_found()
 
     if not user_prompt:
-        return render_template('edit.html', filenames=current_filenames, ia_result="Por favor, escribe tu instrucción para la IA.")
+        return render_edit_page(upload_id, upload, ia_result="Por favor, escribe tu instrucción para la IA.")
     
     # VERIFICACIÓN CRÍTICA: Si el cliente no se inicializó, devuelve el error CLARO
     if gemini_client is None:
         error_msg = "Error: El Asistente de IA no se pudo conectar. Verifica que la variable GEMINI_API_KEY esté correctamente configurada en Render."
-        return render_template('edit.html', filenames=current_filenames, ia_result=error_msg)
+        return render_edit_page(upload_id, upload, ia_result=error_msg)
 
     # 1. Definir la instrucción precisa (el "prompt") para Gemini
     prompt = f"""
@@ -254,20 +1575,65 @@ def generate_ia():
     Descripción: [Descripción generada aquí]
     """
     
-    # 2. Llamar a la API de Gemini
+    # 2. Llamar a la API de Gemini (con caché, límite de ritmo y reintentos)
     try:
-        response = gemini_client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
-        
-        ia_result = response.text.strip()
+        ia_result = generate_text(prompt)
         
+    except GeminiRateLimited as e:
+        ia_result = f"Error de IA: {e}"
     except Exception as e:
         ia_result = f"Error de IA: Falló la comunicación con Gemini. Detalles: {e}"
 
     # 3. Regresar a la página de edición con el resultado
-    return render_template('edit.html', filenames=current_filenames, ia_result=ia_result)
+    return render_edit_page(upload_id, upload, ia_result=ia_result)
+
+# 7. Ruta de Títulos con IA: sugiere un título para cada imagen en una sola llamada
+@app.route('/generate-titles', methods=['POST'])
+def generate_titles():
+    user_prompt = request.form.get('ia_prompt', '')
+    upload_id = request.form.get('upload_id')
+    upload = upload_sessions.get(upload_id, current_owner_id())
+    if upload is None:
+        return upload_not_found()
+
+    if gemini_client is None:
+        error_msg = "Error: El Asistente de IA no se pudo conectar. Verifica que la variable GEMINI_API_KEY esté correctamente configurada en Render."
+        return render_edit_page(upload_id, upload, ia_result=error_msg)
+
+    image_dir = app.config['UPLOAD_FOLDER']
+    filepaths = [os.path.join(image_dir, image['filename']) for image in upload_index.files(upload_id)]
+    # Las subidas pueden haber caducado mientras el usuario editaba
+    filepaths = [filepath for filepath in filepaths if os.path.isfile(filepath)]
+    if not filepaths:
+        return render_edit_page(upload_id, upload, ia_result="No hay imágenes para titular.")
+
+    try:
+        titles = generate_image_titles(filepaths, user_prompt)
+        # Los títulos quedan guardados en el portafolio (se mantienen al usar el otro asistente)
+        upload_sessions.set_titles(upload_id, {os.path.basename(filepath): title for filepath, title in titles.items()})
+        upload = upload_sessions.get(upload_id, current_owner_id())
+        ia_result = None
+    except GeminiRateLimited as e:
+        ia_result = f"Error de IA: {e}"
+    except Exception as e:
+        ia_result = f"Error de IA: Falló la generación de títulos con Gemini. Detalles: {e}"
+
+    return render_edit_page(upload_id, upload, ia_result=ia_result)
+
+# 8. Métricas en formato de texto de Prometheus
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Respuesta cuando la subida supera MAX_CONTENT_LENGTH
+@app.errorhandler(413)
+def upload_too_large(error):
+    max_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return render_template(
+        'message.html',
+        title="Subida demasiado grande",
+        message=f"El total de las imágenes supera el límite de {max_mb} MB. Sube menos imágenes o de menor tamaño."
+    ), 413
 
 # Punto de entrada principal para ejecutar la aplicación
 if __name__ == '__main__':
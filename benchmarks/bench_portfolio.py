@@ -0,0 +1,361 @@
+# Benchmark del flujo completo: /upload -> /generate-titles -> /create-pdf
+#
+# Ejecuta la aplicación con el cliente de pruebas de Flask, imágenes sintéticas
+# y un cliente de Gemini falso (no hace llamadas reales ni necesita API key).
+# Por defecto el PDF se pide como lo hace edit.html (mode=job, consultando
+# /jobs/<id> hasta que está listo y descargándolo); con --pdf-mode sync se mide
+# la respuesta directa de /create-pdf.
+#
+# Las imágenes se generan en el proceso principal y se guardan en disco; cada
+# escenario se mide en un proceso nuevo que solo importa la app y ejecuta los
+# flujos, así que el pico de memoria (RSS) es el de ese escenario. Los
+# resultados se guardan en JSON para comparar ejecuciones:
+#
+#   python benchmarks/bench_portfolio.py --output bench_results.json
+#   python benchmarks/bench_portfolio.py --baseline bench_results.json
+#   python benchmarks/bench_portfolio.py --scenario fotos:12:4000x3000:JPEG --iterations 3
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# nombre, número de imágenes, resolución, formato
+DEFAULT_SCENARIOS = [
+    ('pequeno', 4, (1280, 960), 'JPEG'),
+    ('fotos_movil', 12, (4000, 3000), 'JPEG'),
+    ('capturas_png', 6, (1920, 1080), 'PNG'),
+]
+
+# Etapas medidas según cómo se pide el PDF
+STAGES = {
+    'job': ('upload', 'generate_titles', 'create_pdf_job', 'total'),
+    'sync': ('upload', 'generate_titles', 'create_pdf', 'total'),
+}
+# Intervalo de consulta de /jobs/<id> (edit.html usa 1 s; aquí interesa la latencia real)
+JOB_POLL_SECONDS = 0.01
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGeminiClient:
+    """Sustituto de genai.Client: responde al instante y de forma determinista"""
+
+    def __init__(self):
+        self.models = self
+
+    def generate_content(self, model, contents, config=None):
+        if isinstance(contents, str):
+            return FakeResponse("Título: Portafolio\nDescripción: Descripción de prueba")
+        names = [part.split(': ', 1)[1] for part in contents if isinstance(part, str) and part.startswith('Archivo: ')]
+        return FakeResponse(json.dumps({'titles': [{'filename': name, 'title': f"Título {name}"} for name in names]}))
+
+def make_image(size, image_format, seed):
+    """Imagen sintética con degradado y rectángulos (distinta para cada semilla)"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    width, height = size
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4 + 1), y0 + rng.randrange(height // 4 + 1)
+        draw.rectangle((x0, y0, x1, y1), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+
+    data = io.BytesIO()
+    img.save(data, image_format, **({'quality': 90} if image_format == 'JPEG' else {}))
+    return data.getvalue()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def max_rss_mb():
+    """Pico de memoria del proceso (ru_maxrss está en KB en Linux y en bytes en macOS)"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+def run_flow(app_module, image_paths, pdf_mode):
+    """Ejecuta una vez el flujo completo. Devuelve (tiempos por etapa, tamaño del PDF)"""
+    client = app_module.app.test_client()
+    names = [os.path.basename(path) for path in image_paths]
+    timings = {}
+
+    start = time.perf_counter()
+    files = [open(path, 'rb') for path in image_paths]
+    try:
+        response = client.post(
+            '/upload', data={'file': list(zip(files, names))}, content_type='multipart/form-data'
+        )
+    finally:
+        for f in files:
+            f.close()
+    timings['upload'] = time.perf_counter() - start
+    assert response.status_code == 200, f"/upload respondió {response.status_code}"
+    # El id del portafolio viaja en los formularios de edit.html
+    upload_id = re.search(r'name="upload_id" value="([^"]+)"', response.get_data(as_text=True)).group(1)
+
+    stage_start = time.perf_counter()
+    response = client.post('/generate-titles', data={'ia_prompt': 'benchmark', 'upload_id': upload_id})
+    timings['generate_titles'] = time.perf_counter() - stage_start
+    assert response.status_code == 200, f"/generate-titles respondió {response.status_code}"
+
+    stage_start = time.perf_counter()
+    form = {'selected_images': names, 'upload_id': upload_id}
+    form.update({f"title_{name}": f"Título {name}" for name in names})
+    if pdf_mode == 'sync':
+        response = client.post('/create-pdf', data=form)
+        timings['create_pdf'] = time.perf_counter() - stage_start
+        assert response.status_code == 200, f"/create-pdf respondió {response.status_code}"
+    else:
+        # Lo mismo que hace edit.html: encolar, consultar el progreso y descargar
+        response = client.post('/create-pdf', data={**form, 'mode': 'job'})
+        assert response.status_code == 202, f"/create-pdf (mode=job) respondió {response.status_code}"
+        job = response.get_json()
+        while True:
+            status = client.get(job['status_url']).get_json()
+            if status['state'] == 'done':
+                break
+            assert status['state'] != 'error', f"el trabajo de PDF falló: {status['error']}"
+            time.sleep(JOB_POLL_SECONDS)
+        response = client.get(job['download_url'])
+        timings['create_pdf_job'] = time.perf_counter() - stage_start
+        assert response.status_code == 200, f"/jobs/<id>/download respondió {response.status_code}"
+
+    timings['total'] = time.perf_counter() - start
+    return timings, len(response.data)
+
+def write_images(workdir, scenario, iterations, warm_cache):
+    """Genera en disco las imágenes de cada iteración (fuera del proceso que se mide)"""
+    name, count, size, image_format = scenario
+    ext = 'jpg' if image_format == 'JPEG' else 'png'
+    images_dir = os.path.join(workdir, 'images')
+    os.makedirs(images_dir)
+
+    # Con warm_cache todas las iteraciones repiten las mismas imágenes
+    flows = []
+    for iteration in range(1 if warm_cache else iterations):
+        paths = []
+        for i in range(count):
+            path = os.path.join(images_dir, f"{iteration}-imagen_{i}.{ext}")
+            with open(path, 'wb') as f:
+                f.write(make_image(size, image_format, seed=iteration * 1000 + i))
+            paths.append(path)
+        flows.append(paths)
+    return flows * iterations if warm_cache else flows
+
+def run_scenario(scenario, flows, workdir, iterations, concurrency, pdf_mode, warm_cache, result_queue):
+    """Proceso hijo: importa la app en un entorno aislado y mide el escenario"""
+    name, count, size, image_format = scenario
+
+    # Todas las carpetas y bases de datos de la app en el directorio temporal del escenario
+    os.environ.update({
+        'CACHE_FOLDER': os.path.join(workdir, 'cache'),
+        'JOBS_FOLDER': os.path.join(workdir, 'jobs'),
+        'DATA_FOLDER': os.path.join(workdir, 'data'),
+        'UPLOAD_REAPER_INTERVAL': '0',
+        'GEMINI_RATE_PER_SECOND': '1000000',
+        'GEMINI_RATE_BURST': '1000000',
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as app_module
+    app_module.gemini_client = FakeGeminiClient()
+    rss_before_mb = max_rss_mb()
+
+    upload_bytes = sum(os.path.getsize(path) for path in flows[0])
+    results = []
+    lock = threading.Lock()
+    pending = list(flows)
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                image_paths = pending.pop()
+            outcome = run_flow(app_module, image_paths, pdf_mode)
+            with lock:
+                results.append(outcome)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - start
+    peak_rss_mb = max_rss_mb()
+    if len(results) != len(flows):
+        raise RuntimeError(f"solo terminaron {len(results)} de {len(flows)} flujos")
+
+    latency = {}
+    for stage in STAGES[pdf_mode]:
+        values = [timings[stage] for timings, _ in results]
+        latency[stage] = {
+            'p50_ms': round(statistics.median(values) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'max_ms': round(max(values) * 1000, 2),
+        }
+
+    result_queue.put({
+        'name': name,
+        'images': count,
+        'resolution': f"{size[0]}x{size[1]}",
+        'format': image_format,
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'pdf_mode': pdf_mode,
+        'warm_cache': warm_cache,
+        'upload_bytes': upload_bytes,
+        'latency': latency,
+        'throughput_flows_per_s': round(len(results) / wall_seconds, 3),
+        'rss_after_import_mb': round(rss_before_mb, 1),
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        'pdf_bytes': round(statistics.mean(size for _, size in results)),
+    })
+
+def parse_scenario(text):
+    """nombre:cantidad:ANCHOxALTO:FORMATO -> tupla de escenario"""
+    try:
+        name, count, resolution, image_format = text.split(':')
+        width, height = (int(value) for value in resolution.lower().split('x'))
+        image_format = image_format.upper().replace('JPG', 'JPEG')
+        if image_format not in ('JPEG', 'PNG') or int(count) < 1 or width < 1 or height < 1:
+            raise ValueError(text)
+        return name, int(count), (width, height), image_format
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Escenario inválido '{text}' (usa nombre:cantidad:ANCHOxALTO:JPEG|PNG, con cantidad y tamaño mayores que 0)"
+        )
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, text=True).strip()
+    except Exception:
+        return None
+
+def print_report(report, baseline=None):
+    previous = {scenario['name']: scenario for scenario in (baseline or {}).get('scenarios', [])}
+    for scenario in report['scenarios']:
+        print(f"\n== {scenario['name']}: {scenario['images']} x {scenario['resolution']} {scenario['format']} "
+              f"({scenario['iterations']} iteraciones, concurrencia {scenario['concurrency']})")
+        for stage, stats in scenario['latency'].items():
+            line = f"  {stage:<16} p50 {stats['p50_ms']:>9.1f} ms   p95 {stats['p95_ms']:>9.1f} ms"
+            old = previous.get(scenario['name'])
+            if old and stage in old['latency']:
+                old_p50 = old['latency'][stage]['p50_ms']
+                if old_p50:
+                    line += f"   ({(stats['p50_ms'] - old_p50) / old_p50 * 100:+.1f}% p50)"
+            print(line)
+        print(f"  rendimiento {scenario['throughput_flows_per_s']} flujos/s   "
+              f"RSS pico {scenario['peak_rss_mb']} MB (tras importar la app {scenario['rss_after_import_mb']} MB)   "
+              f"PDF {scenario['pdf_bytes'] / 1024:.0f} KB (subida {scenario['upload_bytes'] / 1024:.0f} KB)")
+    for failure in report['failed']:
+        print(f"\n!! {failure['name']}: {failure['error']}")
+
+def wait_for_result(process, result_queue, timeout):
+    """Espera el resultado del proceso hijo. Devuelve (resultado, None) o (None, motivo del fallo)"""
+    deadline = time.monotonic() + timeout
+    result = None
+    while result is None:
+        try:
+            result = result_queue.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                # Puede haber terminado justo después de enviar el resultado
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    break
+            elif time.monotonic() > deadline:
+                process.terminate()
+                process.join()
+                return None, f"no terminó en {timeout:.0f} s"
+
+    process.join()
+    if result is None or process.exitcode != 0:
+        return None, f"el proceso terminó con código {process.exitcode} (el error está en la salida de arriba)"
+    return result, None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del flujo upload -> create-pdf")
+    parser.add_argument('--scenario', action='append', type=parse_scenario,
+                        help="nombre:cantidad:ANCHOxALTO:JPEG|PNG (se puede repetir)")
+    parser.add_argument('--iterations', type=int, default=5, help="flujos completos por escenario")
+    parser.add_argument('--concurrency', type=int, default=1, help="flujos simultáneos (hilos)")
+    parser.add_argument('--pdf-mode', choices=sorted(STAGES), default='job',
+                        help="job: como edit.html (encolar y consultar /jobs/<id>); sync: respuesta directa")
+    parser.add_argument('--timeout', type=float, default=1800, help="segundos máximos por escenario")
+    parser.add_argument('--warm-cache', action='store_true', help="repetir las mismas imágenes (caché de derivados caliente)")
+    parser.add_argument('--output', default='bench_results.json', help="archivo JSON de resultados")
+    parser.add_argument('--baseline', help="JSON de una ejecución anterior para comparar")
+    args = parser.parse_args()
+
+    # 'spawn' garantiza un proceso limpio (y un RSS propio) por escenario
+    context = multiprocessing.get_context('spawn')
+    scenarios = []
+    failed = []
+    for scenario in args.scenario or DEFAULT_SCENARIOS:
+        workdir = tempfile.mkdtemp(prefix='bench-portfolio-')
+        try:
+            flows = write_images(workdir, scenario, args.iterations, args.warm_cache)
+            result_queue = context.Queue()
+            process = context.Process(
+                target=run_scenario,
+                args=(scenario, flows, workdir, args.iterations, args.concurrency, args.pdf_mode,
+                      args.warm_cache, result_queue)
+            )
+            process.start()
+            result, error = wait_for_result(process, result_queue, args.timeout)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if error:
+            print(f"El escenario {scenario[0]} falló: {error}", file=sys.stderr)
+            failed.append({'name': scenario[0], 'error': error})
+        else:
+            scenarios.append(result)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scenarios': scenarios,
+        'failed': failed,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {args.output}")
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+# Entorno aislado para las pruebas: la app se importa desde un directorio
+# temporal, así que uploads/, data/, cache/ y jobs/ se crean ahí y no en el
+# repositorio. Sin hilo de limpieza en segundo plano.
+
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='test-portfolio-')
+
+os.environ['UPLOAD_REAPER_INTERVAL'] = '0'
+os.chdir(WORKDIR)
+sys.path.insert(0, REPO_ROOT)
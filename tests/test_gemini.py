@@ -0,0 +1,157 @@
+# Pruebas de las llamadas a Gemini con un cliente falso (sin red ni API key):
+# reintentos, límite de ritmo, caché y agrupación de peticiones idénticas.
+#
+#   python -m pytest tests
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from google.genai import errors
+
+import app
+from conftest import REPO_ROOT, WORKDIR
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGeminiClient:
+    """Sustituto de genai.Client: falla las primeras 'failures' llamadas y puede quedarse bloqueado"""
+
+    def __init__(self, failures=(), text="Título: Prueba", block=False):
+        self.models = self
+        self.failures = list(failures)
+        self.text = text
+        self.calls = 0
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        self.entered.set()
+        self.release.wait(timeout=5)
+        if self.failures:
+            raise self.failures.pop(0)
+        return FakeResponse(self.text)
+
+@pytest.fixture(autouse=True)
+def gemini(monkeypatch):
+    """Estado de Gemini limpio en cada prueba y reintentos sin esperas reales"""
+    app.gemini_cache.clear()
+    app.gemini_inflight.clear()
+    monkeypatch.setattr(app, 'GEMINI_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(app, 'GEMINI_RETRY_INITIAL_SECONDS', 0.001)
+    monkeypatch.setattr(app, 'GEMINI_RETRY_MAX_SECONDS', 0.001)
+    monkeypatch.setattr(app, 'gemini_rate_limiter', app.TokenBucket(1000, 1000))
+
+    def use(client):
+        monkeypatch.setattr(app, 'gemini_client', client)
+        return client
+    return use
+
+def coalesced_count():
+    return app.metrics._counters.get(('portfolio_gemini_requests_total', (('result', 'coalesced'),)), 0)
+
+@pytest.mark.parametrize('code', [429, 500, 503])
+def test_retries_temporary_errors(gemini, code):
+    error_class = errors.ClientError if code < 500 else errors.ServerError
+    client = gemini(FakeGeminiClient(failures=[error_class(code, {}), error_class(code, {})]))
+
+    assert app.generate_text("hola") == "Título: Prueba"
+    assert client.calls == 3
+
+def test_retries_timeouts(gemini):
+    client = gemini(FakeGeminiClient(failures=[TimeoutError()]))
+
+    assert app.generate_text("hola") == "Título: Prueba"
+    assert client.calls == 2
+
+def test_gives_up_after_max_attempts(gemini):
+    client = gemini(FakeGeminiClient(failures=[errors.ServerError(503, {}) for _ in range(5)]))
+
+    with pytest.raises(errors.ServerError):
+        app.generate_text("hola")
+    assert client.calls == app.GEMINI_MAX_ATTEMPTS
+    assert not app.gemini_cache
+
+def test_does_not_retry_client_errors(gemini):
+    client = gemini(FakeGeminiClient(failures=[errors.ClientError(400, {})]))
+
+    with pytest.raises(errors.ClientError):
+        app.generate_text("hola")
+    assert client.calls == 1
+
+def test_rate_limited_without_free_slot(gemini, monkeypatch):
+    client = gemini(FakeGeminiClient())
+    monkeypatch.setattr(app, 'gemini_rate_limiter', app.TokenBucket(0.001, 1))
+    monkeypatch.setattr(app, 'GEMINI_RATE_LIMIT_WAIT_SECONDS', 0.05)
+
+    app.generate_text("primera")
+    with pytest.raises(app.GeminiRateLimited):
+        app.generate_text("segunda")
+    assert client.calls == 1
+
+def test_cache_hit_skips_the_api(gemini):
+    client = gemini(FakeGeminiClient())
+
+    assert app.generate_text("hola   mundo") == app.generate_text(" hola mundo ")
+    assert client.calls == 1
+
+def test_identical_requests_share_one_call(gemini):
+    client = gemini(FakeGeminiClient(block=True))
+    coalesced_before = coalesced_count()
+    results = []
+
+    leader = threading.Thread(target=lambda: results.append(app.generate_text("hola")))
+    leader.start()
+    assert client.entered.wait(timeout=5)
+    follower = threading.Thread(target=lambda: results.append(app.generate_text("hola")))
+    follower.start()
+    while coalesced_count() == coalesced_before:
+        time.sleep(0.01)  # Hasta que el seguidor espera al futuro del líder
+
+    client.release.set()
+    leader.join(timeout=5)
+    follower.join(timeout=5)
+    assert results == ["Título: Prueba", "Título: Prueba"]
+    assert client.calls == 1
+
+def test_follower_receives_leader_error(gemini):
+    client = gemini(FakeGeminiClient(failures=[errors.ClientError(400, {})], block=True))
+    coalesced_before = coalesced_count()
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(app.generate_text("hola"))
+        except errors.ClientError as e:
+            outcomes.append(e.code)
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    threads[0].start()
+    assert client.entered.wait(timeout=5)
+    threads[1].start()
+    while coalesced_count() == coalesced_before:
+        time.sleep(0.01)
+
+    client.release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert outcomes == [400, 400]
+    assert client.calls == 1
+    assert not app.gemini_inflight
+
+@pytest.mark.parametrize('rate, burst', [('0', '5'), ('-1', '5'), ('1', '0')])
+def test_rejects_invalid_rate_limit(rate, burst):
+    env = {**os.environ, 'GEMINI_RATE_PER_SECOND': rate, 'GEMINI_RATE_BURST': burst, 'PYTHONPATH': REPO_ROOT}
+    result = subprocess.run(
+        [sys.executable, '-c', 'import app'], cwd=WORKDIR, env=env, capture_output=True, text=True
+    )
+    assert result.returncode != 0
+    assert 'GEMINI_RATE_PER_SECOND' in result.stderr
@@ -0,0 +1,82 @@
+# Pruebas de aislamiento entre usuarios: con otra cookie de sesión no se puede
+# ver, usar ni descargar nada de un portafolio ajeno.
+#
+#   python -m pytest tests
+
+import io
+import os
+import re
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+def make_png():
+    data = io.BytesIO()
+    Image.new('RGB', (64, 48), (10, 120, 200)).save(data, 'PNG')
+    return data.getvalue()
+
+@pytest.fixture
+def owner():
+    """Cliente que ha subido una imagen: (cliente, upload_id, nombre guardado)"""
+    client = app.app.test_client()
+    response = client.post('/upload', data={'file': [(io.BytesIO(make_png()), 'foto.png')]}, content_type='multipart/form-data')
+    upload_id = re.search(r'name="upload_id" value="([^"]+)"', response.get_data(as_text=True)).group(1)
+    [image] = app.upload_index.files(upload_id)
+    yield client, upload_id, image['filename']
+    app.remove_upload_files([os.path.join(app.UPLOAD_FOLDER, image['filename'])
+                             for image in app.upload_index.files(upload_id)])
+    app.upload_sessions.delete(upload_id)
+
+@pytest.fixture
+def stranger():
+    return app.app.test_client()
+
+def wait_for_job(client, job_id):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['state'] in ('done', 'error'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"El trabajo {job_id} no terminó")
+
+@pytest.mark.parametrize('route', ['/uploads/{}', '/thumbnails/{}'])
+def test_images_are_private(owner, stranger, route):
+    client, _, filename = owner
+
+    assert client.get(route.format(filename)).status_code == 200
+    assert stranger.get(route.format(filename)).status_code == 404
+
+def test_cannot_build_someone_elses_portfolio(owner, stranger):
+    _, upload_id, _ = owner
+
+    for mode in ('job', 'sync'):
+        response = stranger.post('/create-pdf', data={'upload_id': upload_id, 'selected_images': 'foto.png', 'mode': mode})
+        assert response.status_code == 400
+    assert len(app.upload_index.files(upload_id)) == 1  # Nada se ha borrado
+
+@pytest.mark.parametrize('route', ['/generate-ia', '/generate-titles'])
+def test_cannot_use_ai_on_someone_elses_portfolio(owner, stranger, route):
+    _, upload_id, _ = owner
+
+    response = stranger.post(route, data={'upload_id': upload_id, 'ia_prompt': "hola"})
+    assert response.status_code == 404
+
+def test_jobs_are_private(owner, stranger):
+    client, upload_id, _ = owner
+    response = client.post('/create-pdf', data={'upload_id': upload_id, 'selected_images': 'foto.png', 'mode': 'job'})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+
+    assert stranger.get(f'/jobs/{job_id}').status_code == 404
+    assert stranger.get(f'/jobs/{job_id}/download').status_code == 404
+
+    assert wait_for_job(client, job_id)['state'] == 'done'
+    assert stranger.get(f'/jobs/{job_id}').status_code == 404
+    assert stranger.get(f'/jobs/{job_id}/download').status_code == 404
+    download = client.get(f'/jobs/{job_id}/download')
+    assert download.status_code == 200
+    assert download.data.startswith(b'%PDF-')
@@ -0,0 +1,111 @@
+# Pruebas de los títulos por imagen (/generate-titles) con un cliente de Gemini
+# falso y determinista: respuesta JSON, nombres de archivo y caché.
+#
+#   python -m pytest tests
+
+import io
+import json
+import os
+import re
+
+import pydantic
+import pytest
+from PIL import Image
+
+import app
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeTitlesClient:
+    """Sustituto de genai.Client: titula cada 'Archivo: <nombre>' que recibe (y uno que no existe)"""
+
+    def __init__(self, raw_text=None):
+        self.models = self
+        self.raw_text = raw_text
+        self.calls = []
+
+    def generate_content(self, model, contents, config=None):
+        self.calls.append((contents, config))
+        if self.raw_text is not None:
+            return FakeResponse(self.raw_text)
+        names = [part.split(': ', 1)[1] for part in contents if isinstance(part, str) and part.startswith('Archivo: ')]
+        titles = [{'filename': name, 'title': f"Título {name}"} for name in names]
+        titles.append({'filename': 'inventada.png', 'title': "No pedida"})
+        return FakeResponse(json.dumps({'titles': titles}))
+
+@pytest.fixture
+def titles_client(monkeypatch):
+    app.gemini_cache.clear()
+    app.gemini_inflight.clear()
+    monkeypatch.setattr(app, 'gemini_rate_limiter', app.TokenBucket(1000, 1000))
+    client = FakeTitlesClient()
+    monkeypatch.setattr(app, 'gemini_client', client)
+    return client
+
+def make_image(color, image_format='PNG'):
+    data = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(data, image_format)
+    return data.getvalue()
+
+def write_image(folder, filename, color):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, filename)
+    with open(path, 'wb') as f:
+        f.write(make_image(color))
+    return path
+
+def test_titles_are_parsed_and_mapped_to_paths(titles_client, tmp_path):
+    paths = [
+        write_image(tmp_path, 'sesion_playa.png', (10, 120, 200)),
+        write_image(tmp_path, 'sesion_bosque.png', (20, 160, 40)),
+    ]
+
+    titles = app.generate_image_titles(paths, "tono alegre")
+
+    # Los nombres vuelven a las rutas completas; el que la IA inventó se descarta
+    assert titles == {paths[0]: "Título playa.png", paths[1]: "Título bosque.png"}
+    contents, config = titles_client.calls[0]
+    assert config.response_schema is app.ImageTitles
+    assert [part for part in contents if isinstance(part, str) and part.startswith('Archivo: ')] == [
+        "Archivo: playa.png", "Archivo: bosque.png"
+    ]
+    assert sum(1 for part in contents if not isinstance(part, str)) == 2  # Una miniatura por imagen
+
+def test_invalid_json_is_rejected(titles_client, tmp_path):
+    titles_client.raw_text = '{"titles": [{"filename": "playa.png"}]}'  # Falta el título
+    path = write_image(tmp_path, 'sesion_playa.png', (10, 120, 200))
+
+    with pytest.raises(pydantic.ValidationError):
+        app.generate_image_titles([path])
+
+def test_cache_is_keyed_on_image_contents(titles_client, tmp_path):
+    path = write_image(tmp_path / 'a', 'sesion_playa.png', (10, 120, 200))
+    same_name_other_image = write_image(tmp_path / 'b', 'sesion_playa.png', (200, 10, 10))
+
+    app.generate_image_titles([path], "tono alegre")
+    app.generate_image_titles([path], "tono   alegre")
+    assert len(titles_client.calls) == 1
+
+    # Mismo nombre de archivo pero otra imagen: no puede reutilizar la respuesta
+    app.generate_image_titles([same_name_other_image], "tono alegre")
+    assert len(titles_client.calls) == 2
+
+def test_generate_titles_prefills_title_inputs(titles_client):
+    client = app.app.test_client()
+    response = client.post('/upload', data={'file': [
+        (io.BytesIO(make_image((10, 120, 200))), 'playa.png'),
+        (io.BytesIO(make_image((20, 160, 40), 'JPEG')), 'bosque.jpg'),
+    ]}, content_type='multipart/form-data')
+    upload_id = re.search(r'name="upload_id" value="([^"]+)"', response.get_data(as_text=True)).group(1)
+
+    response = client.post('/generate-titles', data={'upload_id': upload_id, 'ia_prompt': "tono alegre"})
+
+    html = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert 'name="title_playa.png" value="Título playa.png"' in html
+    assert 'name="title_bosque.jpg" value="Título bosque.jpg"' in html
+    assert len(titles_client.calls) == 1
+    app.remove_upload_files([os.path.join(app.UPLOAD_FOLDER, image['filename'])
+                             for image in app.upload_index.files(upload_id)])
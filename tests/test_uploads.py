@@ -0,0 +1,93 @@
+# Pruebas de las subidas en streaming: ningún archivo temporal (.part) debe
+# quedarse en disco, tanto si la imagen se rechaza como si la petición se corta.
+#
+#   python -m pytest tests
+
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import app
+
+BOUNDARY = 'prueba-limite'
+
+def make_png(size=(1200, 1200)):
+    """PNG con ruido (no se comprime casi nada, así ocupa varios MB)"""
+    data = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(data, 'PNG')
+    return data.getvalue()
+
+def multipart_body(filename, data, complete=True):
+    """Cuerpo multipart con un solo archivo; complete=False lo corta sin el cierre"""
+    head = (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode()
+    return head + data + (f'\r\n--{BOUNDARY}--\r\n'.encode() if complete else b'')
+
+def temp_files():
+    return [name for name in os.listdir(app.app.config['UPLOAD_FOLDER']) if name.endswith('.part')]
+
+def uploaded_paths():
+    return set(app.upload_index.all_paths())
+
+@pytest.fixture
+def client():
+    before = uploaded_paths()
+    yield app.app.test_client()
+    assert temp_files() == []
+    app.remove_upload_files(list(uploaded_paths() - before))
+
+def test_accepted_upload_is_committed(client):
+    before = uploaded_paths()
+    response = client.post('/upload', data={'file': [(io.BytesIO(make_png((40, 30))), 'foto.png')]}, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    [path] = uploaded_paths() - before
+    assert os.path.isfile(path)
+
+def test_rejected_file_is_discarded(client):
+    before = uploaded_paths()
+    response = client.post('/upload', data={'file': [(io.BytesIO(b'no es una imagen' * 100), 'falsa.png')]}, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert 'no es una imagen válida' in response.get_data(as_text=True)
+    assert uploaded_paths() == before
+
+def test_oversized_file_is_discarded(client, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_UPLOAD_FILE_BYTES', 64 * 1024)
+    before = uploaded_paths()
+    response = client.post('/upload', data={'file': [(io.BytesIO(make_png()), 'grande.png')]}, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert 'supera el tamaño máximo' in response.get_data(as_text=True)
+    assert uploaded_paths() == before
+
+def test_chunked_request_over_limit_leaves_no_temp_file(client, monkeypatch):
+    data = make_png()
+    monkeypatch.setitem(app.app.config, 'MAX_CONTENT_LENGTH', len(data) // 2)
+    before = uploaded_paths()
+    # Sin Content-Length (chunked), el límite salta a mitad de la lectura
+    client.post(
+        '/upload',
+        input_stream=io.BytesIO(multipart_body('grande.png', data)),
+        content_type=f'multipart/form-data; boundary={BOUNDARY}',
+        headers={'Transfer-Encoding': 'chunked'},
+        environ_overrides={'wsgi.input_terminated': True},
+    )
+
+    assert uploaded_paths() == before
+
+def test_aborted_request_leaves_no_temp_file(client):
+    data = make_png()
+    before = uploaded_paths()
+    # Como si el cliente se desconectara a mitad del archivo
+    client.post(
+        '/upload',
+        data=multipart_body('cortada.png', data[:len(data) // 2], complete=False),
+        content_type=f'multipart/form-data; boundary={BOUNDARY}',
+    )
+
+    assert uploaded_paths() == before